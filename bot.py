@@ -1,25 +1,48 @@
 import asyncio
 import base64
 import boto3
+import contextlib
+import contextvars
+import functools
 import os
+import requests
 import spotipy
 import logging
 import re
 import json
 import telegram
+import threading
+import time
+import urllib3
+import uuid
+from collections import OrderedDict, deque
 from enum import Enum
-from telegram import Update, LinkPreviewOptions
+from telegram import (
+    Update,
+    LinkPreviewOptions,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+)
 from telegram.ext import (
     Application,
     CommandHandler,
+    InlineQueryHandler,
     MessageHandler,
     filters,
     CallbackContext,
     Defaults,
+    TypeHandler,
+)
+from spotipy.oauth2 import (
+    SpotifyOAuth,
+    SpotifyClientCredentials,
+    SpotifyOauthError,
+    CacheHandler,
 )
-from spotipy.oauth2 import SpotifyOAuth, CacheHandler
+from spotipy.cache_handler import MemoryCacheHandler
 from spotipy.exceptions import SpotifyException
 import urllib.parse
+from botocore.exceptions import ClientError
 
 
 if logging.getLogger().hasHandlers():
@@ -37,12 +60,73 @@ defaults = Defaults(
 SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
 SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
 SPOTIFY_REDIRECT_URI = os.getenv("SPOTIFY_REDIRECT_URI")
+# Bots served by this deployment, e.g.
+# TELEGRAM_BOTS='{"skunk": {"token": "123:abc", "secret": "s3cr3t"}}'. The bot
+# from TELEGRAM_BOT_TOKEN is served as DEFAULT_BOT, whose DynamoDB keys are
+# left unprefixed so existing single-bot data keeps working.
+DEFAULT_BOT = "default"
 spotify_link_pattern = r"https://open\.spotify\.com/track/([a-zA-Z0-9]+)"
+# Spotify circuit breaker: open once at least SPOTIFY_BREAKER_MIN_CALLS calls in
+# the last SPOTIFY_BREAKER_WINDOW seconds failed at SPOTIFY_BREAKER_FAILURE_RATE
+# or more, and let a trial call through after SPOTIFY_BREAKER_COOLDOWN seconds.
+SPOTIFY_BREAKER_FAILURE_RATE = float(os.getenv("SPOTIFY_BREAKER_FAILURE_RATE", "0.5"))
+SPOTIFY_BREAKER_MIN_CALLS = int(os.getenv("SPOTIFY_BREAKER_MIN_CALLS", "4"))
+SPOTIFY_BREAKER_WINDOW = float(os.getenv("SPOTIFY_BREAKER_WINDOW", "60"))
+SPOTIFY_BREAKER_COOLDOWN = float(os.getenv("SPOTIFY_BREAKER_COOLDOWN", "30"))
+# Spotify accepts at most 100 items per playlist_add_items call.
+OUTBOX_BATCH_SIZE = 100
+# Replays a track may fail on auth errors before it is dropped from the outbox.
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+SPOTIFY_API_URL = "https://api.spotify.com/v1/"
+SPOTIFY_ACCOUNTS_URL = "https://accounts.spotify.com/"
+# Inline search: results per query, size and lifetime (seconds) of the search
+# cache shared by all users of the process, and how long (seconds) a user has to
+# stop typing before their query is searched when debouncing is on.
+INLINE_RESULT_LIMIT = 20
+INLINE_CACHE_SIZE = int(os.getenv("INLINE_CACHE_SIZE", "512"))
+INLINE_CACHE_TTL = float(os.getenv("INLINE_CACHE_TTL", "300"))
+INLINE_DEBOUNCE = float(os.getenv("INLINE_DEBOUNCE", "0.3"))
 # Dynamodb
 dynamodb = boto3.resource("dynamodb", region_name="us-east-1")
 
 bot_table = dynamodb.Table(os.getenv("BOT_TABLE"))
 credentials_table = dynamodb.Table(os.getenv("CREDENTIALS_TABLE"))
+outbox_table = dynamodb.Table(os.getenv("OUTBOX_TABLE", "SpotifySkunkOutbox"))
+
+
+# Name of the bot handling the current update, used to namespace DynamoDB keys.
+current_bot = contextvars.ContextVar("current_bot", default=DEFAULT_BOT)
+
+
+def load_bots():
+    bots = json.loads(os.getenv("TELEGRAM_BOTS", "{}"))
+    token = os.getenv("TELEGRAM_BOT_TOKEN")
+    if token:
+        bots.setdefault(
+            DEFAULT_BOT,
+            {"token": token, "secret": os.getenv("TELEGRAM_WEBHOOK_SECRET")},
+        )
+    return bots
+
+
+BOTS = load_bots()
+
+
+@contextlib.contextmanager
+def bot_namespace(bot_name):
+    reset_token = current_bot.set(bot_name)
+    try:
+        yield
+    finally:
+        current_bot.reset(reset_token)
+
+
+def chat_key(chat_id):
+    # Bots share the tables, so every bot but the default one prefixes its keys.
+    bot_name = current_bot.get()
+    if bot_name == DEFAULT_BOT:
+        return str(chat_id)
+    return f"{bot_name}:{chat_id}"
 
 
 # Enums for bot states
@@ -54,6 +138,7 @@ class BotState(Enum):
     NO_STATE = None
 
 
+@functools.cache
 def load_html_file(file_name):
     with open(os.path.join("html", file_name), encoding="utf-8") as file:
         return file.read()
@@ -64,17 +149,29 @@ def handle_spotify_auth(state, code):
     state_info = json.loads(state_decoded)
     chat_id = state_info.get("chat_id")
     user_id = state_info.get("user_id")
+    bot_name = state_info.get("bot", DEFAULT_BOT)
+    if bot_name not in BOTS:
+        # Retrying can't help, so don't raise.
+        logger.error(f"Spotify auth callback for unknown bot: {bot_name}")
+        return
 
-    sp_oauth = get_sp_oauth(chat_id, user_id)
+    with bot_namespace(bot_name):
+        sp_oauth = get_sp_oauth(chat_id, user_id)
     token_info = sp_oauth.get_access_token(code)
 
     if token_info:
-        TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+        TOKEN = BOTS[bot_name]["token"]
         bot = telegram.Bot(TOKEN)
         logger.info(f"Spotify access token successfully retrieved: {token_info}")
-        asyncio.run(
-            bot.send_message(text="Enter a name for your new playlist", chat_id=chat_id)
-        )
+        try:
+            asyncio.run(
+                bot.send_message(
+                    text="Enter a name for your new playlist", chat_id=chat_id
+                )
+            )
+        except Exception as e:
+            # The code is already exchanged, so a retry could only fail.
+            logger.error(f"Error notifying chat {chat_id} after Spotify auth: {e}")
     else:
         logger.error("Failed to retrieve Spotify access token")
     # For logging:
@@ -93,13 +190,13 @@ def save_current_state(chat_id, state_key: BotState):
 
         if state_key is BotState.NO_STATE:
             response = bot_table.update_item(
-                Key={"chat_id": str(chat_id)},
+                Key={"chat_id": chat_key(chat_id)},
                 UpdateExpression="REMOVE current_state",
                 ReturnValues="UPDATED_NEW",
             )
         else:
             response = bot_table.update_item(
-                Key={"chat_id": str(chat_id)},
+                Key={"chat_id": chat_key(chat_id)},
                 UpdateExpression="SET current_state = :state, user_id = :uid",
                 ExpressionAttributeValues={
                     ":state": state_key.value,
@@ -116,7 +213,7 @@ def save_current_state(chat_id, state_key: BotState):
 def get_current_state(chat_id):
     # Retrieves the current bot state for a given chat_id from DynamoDB.
     try:
-        response = bot_table.get_item(Key={"chat_id": str(chat_id)})
+        response = bot_table.get_item(Key={"chat_id": chat_key(chat_id)})
         if "Item" in response and "current_state" in response["Item"]:
             state_value = response["Item"]["current_state"]
             return BotState(state_value)
@@ -130,7 +227,7 @@ def save_playlist_to_dynamodb(chat_id, playlist_id):
     try:
         bot_table.put_item(
             Item={
-                "chat_id": str(chat_id),
+                "chat_id": chat_key(chat_id),
                 "playlist_id": playlist_id,
                 "user_id": get_user_id_from_chat_id(chat_id),
             }
@@ -141,7 +238,7 @@ def save_playlist_to_dynamodb(chat_id, playlist_id):
 
 def get_playlist_from_dynamodb(chat_id):
     try:
-        response = bot_table.get_item(Key={"chat_id": str(chat_id)})
+        response = bot_table.get_item(Key={"chat_id": chat_key(chat_id)})
         if "Item" in response:
             playlist_id = response["Item"].get("playlist_id")
             return playlist_id
@@ -153,7 +250,7 @@ def get_playlist_from_dynamodb(chat_id):
 
 def get_user_id_from_chat_id(chat_id):
     try:
-        response = bot_table.get_item(Key={"chat_id": str(chat_id)})
+        response = bot_table.get_item(Key={"chat_id": chat_key(chat_id)})
         if "Item" in response and "user_id" in response["Item"]:
             return response["Item"]["user_id"]
         else:
@@ -170,7 +267,7 @@ def get_user_id_from_chat_id(chat_id):
 
 def get_user_id_from_channel_credentials(chat_id):
     try:
-        response = credentials_table.get_item(Key={"chat_id": str(chat_id)})
+        response = credentials_table.get_item(Key={"chat_id": chat_key(chat_id)})
         if "Item" in response and "user_id" in response["Item"]:
             return response["Item"]["user_id"]
         else:
@@ -194,10 +291,11 @@ class DynamoCredentialsCache(CacheHandler):
     def __init__(self, chat_id, user_id):
         self.chat_id = chat_id
         self.user_id = user_id
+        self.key = chat_key(chat_id)
 
     def get_cached_token(self):
         try:
-            response = credentials_table.get_item(Key={"chat_id": str(self.chat_id)})
+            response = credentials_table.get_item(Key={"chat_id": self.key})
             if "Item" in response:
                 return response["Item"]
             return None
@@ -209,13 +307,13 @@ class DynamoCredentialsCache(CacheHandler):
         try:
             credentials_table.put_item(
                 Item={
-                    "chat_id": str(self.chat_id),
+                    "chat_id": self.key,
                     "user_id": self.user_id,
                     **token_info,
                 }
             )
             bot_table.update_item(
-                Key={"chat_id": str(self.chat_id)},
+                Key={"chat_id": self.key},
                 UpdateExpression="SET user_id = :uid",
                 ExpressionAttributeValues={":uid": str(self.user_id)},
             )
@@ -224,9 +322,311 @@ class DynamoCredentialsCache(CacheHandler):
             raise
 
 
+def save_track_to_outbox(chat_id, user_id, playlist_id, track_id):
+    # Queues a track add that could not reach Spotify so it can be replayed later.
+    try:
+        outbox_table.put_item(
+            Item={
+                "outbox_id": str(uuid.uuid4()),
+                "bot": current_bot.get(),
+                "chat_id": str(chat_id),
+                "user_id": str(user_id),
+                "playlist_id": playlist_id,
+                "track_id": track_id,
+                "created_at": int(time.time() * 1000),
+            }
+        )
+        return True
+    except Exception as e:
+        logging.error(f"Error saving track {track_id} to the outbox: {e}")
+        return False
+
+
+# -----------------------------------------------
+# Spotify Circuit Breaker
+# -----------------------------------------------
+class SpotifyUnavailableError(Exception):
+    """Raised when Spotify is failing and the circuit breaker refuses the call."""
+
+
+class SpotifyCircuitBreaker:
+    """
+    Tracks the outcome of recent Spotify calls and stops sending requests once
+    the failure rate in the rolling window crosses the threshold. After the
+    cooldown a single trial call is let through; if it succeeds the breaker
+    closes again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_rate, min_calls, window, cooldown, clock=time.monotonic):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self.clock = clock
+        self.state = self.CLOSED
+        self.opened_at = None
+        # Set once the breaker has opened, so the outbox gets replayed when it
+        # closes again.
+        self.replay_pending = False
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if self.clock() - self.opened_at < self.cooldown:
+                    return False
+                self.state = self.HALF_OPEN
+                return True
+            # Only one trial call at a time while half open.
+            return self.state == self.CLOSED
+
+    def record_success(self):
+        # Returns True when the caller should replay the outbox.
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                logging.info("Spotify circuit breaker closed")
+                self.state = self.CLOSED
+                self._calls.clear()
+            self._record(True)
+            replay, self.replay_pending = self.replay_pending, False
+            return replay
+
+    def request_replay(self):
+        with self._lock:
+            self.replay_pending = True
+
+    def record_failure(self):
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._open()
+                return
+            self._record(False)
+            failures = sum(1 for _, ok in self._calls if not ok)
+            if (
+                len(self._calls) >= self.min_calls
+                and failures / len(self._calls) >= self.failure_rate
+            ):
+                self._open()
+
+    def _record(self, ok):
+        now = self.clock()
+        self._calls.append((now, ok))
+        while self._calls and now - self._calls[0][0] > self.window:
+            self._calls.popleft()
+
+    def _open(self):
+        logging.warning("Spotify circuit breaker opened")
+        self.state = self.OPEN
+        self.opened_at = self.clock()
+        self.replay_pending = True
+        self._calls.clear()
+
+
+spotify_breaker = SpotifyCircuitBreaker(
+    SPOTIFY_BREAKER_FAILURE_RATE,
+    SPOTIFY_BREAKER_MIN_CALLS,
+    SPOTIFY_BREAKER_WINDOW,
+    SPOTIFY_BREAKER_COOLDOWN,
+)
+
+
+def is_spotify_outage(error):
+    # Rate limiting, server errors and network failures count against the
+    # breaker. Other Spotify errors (bad scope, missing playlist) do not.
+    if isinstance(error, SpotifyException):
+        return error.http_status == 429 or error.http_status >= 500
+    if isinstance(error, SpotifyOauthError):
+        # spotipy raises this from inside its handler for the failed token
+        # request, so the HTTP or network error is the context.
+        cause = error.__context__
+        if isinstance(cause, requests.exceptions.HTTPError):
+            status = cause.response.status_code if cause.response is not None else 0
+            return status == 429 or status >= 500
+        return isinstance(cause, requests.exceptions.RequestException)
+    return isinstance(error, requests.exceptions.RequestException)
+
+
+def call_spotify(func, *args, **kwargs):
+    if not spotify_breaker.allow_request():
+        raise SpotifyUnavailableError("Spotify is temporarily unavailable.")
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:
+        if is_spotify_outage(e):
+            spotify_breaker.record_failure()
+            raise SpotifyUnavailableError("Spotify is temporarily unavailable.") from e
+        record_spotify_success()
+        raise
+    record_spotify_success()
+    return result
+
+
+def record_spotify_success():
+    if spotify_breaker.record_success():
+        schedule_outbox_replay()
+
+
+outbox_replay_scheduler = None
+
+
+def set_outbox_replay_scheduler(scheduler):
+    # lambda_main replays the outbox in an asynchronous invocation. Without a
+    # scheduler the replay runs on a background thread.
+    global outbox_replay_scheduler
+    outbox_replay_scheduler = scheduler
+
+
+def schedule_outbox_replay():
+    try:
+        if outbox_replay_scheduler is not None:
+            outbox_replay_scheduler()
+        else:
+            threading.Thread(target=drain_spotify_outbox, daemon=True).start()
+    except Exception as e:
+        logging.error(f"Error scheduling the outbox replay: {e}")
+        spotify_breaker.request_replay()
+
+
+def drain_spotify_outbox():
+    start_key = replay_spotify_outbox()
+    while start_key:
+        start_key = replay_spotify_outbox(start_key)
+
+
+def claim_outbox_item(item):
+    # Deleting the row claims it, so a track is only replayed by whoever
+    # deleted it even when several containers scan the outbox at once.
+    try:
+        response = outbox_table.delete_item(
+            Key={"outbox_id": item["outbox_id"]},
+            ConditionExpression="attribute_exists(outbox_id)",
+            ReturnValues="ALL_OLD",
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            logging.error(f"Error claiming outbox item {item['outbox_id']}: {e}")
+        return None
+    return response.get("Attributes")
+
+
+def release_outbox_items(items, count_attempt=False):
+    # Puts claimed tracks back so a later replay can pick them up. Failures
+    # that are down to the track rather than an outage count towards
+    # OUTBOX_MAX_ATTEMPTS, after which the track is dropped.
+    try:
+        with outbox_table.batch_writer() as batch:
+            for item in items:
+                if count_attempt:
+                    attempts = int(item.get("attempts", 0)) + 1
+                    if attempts >= OUTBOX_MAX_ATTEMPTS:
+                        logging.error(
+                            f"Dropping outbox track {item['track_id']} for playlist "
+                            f"{item['playlist_id']} after {attempts} attempts"
+                        )
+                        continue
+                    item = {**item, "attempts": attempts}
+                batch.put_item(Item=item)
+    except Exception as e:
+        logging.error(f"Error returning {len(items)} track(s) to the outbox: {e}")
+
+
+def replay_spotify_outbox(start_key=None):
+    # Adds one scan page of queued tracks to their playlists in batches. Returns
+    # the key to continue the scan from, or None when there is nothing more to
+    # do. A page where every track was put back again ends the replay, so rows
+    # that keep failing can't keep it going.
+    scan_kwargs = {"Limit": OUTBOX_BATCH_SIZE}
+    if start_key:
+        scan_kwargs["ExclusiveStartKey"] = start_key
+    try:
+        response = outbox_table.scan(**scan_kwargs)
+    except Exception as e:
+        logging.error(f"Error reading the outbox from DynamoDB: {e}")
+        return None
+
+    claimed = [claim_outbox_item(item) for item in response.get("Items", [])]
+    batches = {}
+    for item in sorted(filter(None, claimed), key=lambda i: i["created_at"]):
+        key = (
+            item.get("bot", DEFAULT_BOT),
+            item["chat_id"],
+            item["user_id"],
+            item["playlist_id"],
+        )
+        batches.setdefault(key, []).append(item)
+
+    progressed = False
+    remaining = list(batches.items())
+    while remaining:
+        (bot_name, chat_id, user_id, playlist_id), items = remaining.pop(0)
+        uris = [f"spotify:track:{item['track_id']}" for item in items]
+        try:
+            with bot_namespace(bot_name):
+                sp = get_spotify(get_sp_oauth(chat_id, user_id))
+            call_spotify(sp.playlist_add_items, playlist_id, uris)
+            logging.info(f"Replayed {len(uris)} track(s) to playlist {playlist_id}")
+            progressed = True
+        except SpotifyUnavailableError:
+            release_outbox_items(items + [i for _, rest in remaining for i in rest])
+            return None
+        except SpotifyException as e:
+            if e.http_status == 401:
+                logging.error(f"Keeping outbox tracks for playlist {playlist_id}: {e}")
+                release_outbox_items(items, count_attempt=True)
+            else:
+                # Retrying won't help (e.g. the playlist is gone).
+                logging.error(f"Dropping outbox tracks for playlist {playlist_id}: {e}")
+                progressed = True
+        except Exception as e:
+            # Auth and credential lookup failures may clear up, so keep the rows.
+            logging.error(f"Keeping outbox tracks for playlist {playlist_id}: {e}")
+            release_outbox_items(items, count_attempt=True)
+
+    if not progressed:
+        return None
+    return response.get("LastEvaluatedKey")
+
+
 # -----------------------------------------------
 # Spotify Utility Functions
 # -----------------------------------------------
+class SharedSession(requests.Session):
+    """
+    A requests session shared by every spotipy client in the process so TLS
+    connections to Spotify are reused across requests. spotipy closes its
+    session when a client is garbage collected, so closing is a no-op here.
+    """
+
+    def close(self):
+        pass
+
+
+def build_spotify_session():
+    # Same retry policy spotipy applies to the sessions it builds itself.
+    session = SharedSession()
+    retry = urllib3.Retry(
+        total=3,
+        connect=None,
+        read=False,
+        allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+        status=3,
+        backoff_factor=0.3,
+        status_forcelist=spotipy.Spotify.default_retry_codes,
+    )
+    adapter = requests.adapters.HTTPAdapter(max_retries=retry)
+    session.mount("https://", adapter)
+    return session
+
+
+spotify_session = build_spotify_session()
+spotify_auth_session = SharedSession()
+
+
 def get_sp_oauth(chat_id, user_id):
     return SpotifyOAuth(
         SPOTIFY_CLIENT_ID,
@@ -234,28 +634,54 @@ def get_sp_oauth(chat_id, user_id):
         SPOTIFY_REDIRECT_URI,
         cache_handler=DynamoCredentialsCache(chat_id, user_id),
         scope="playlist-modify-public ugc-image-upload",
+        requests_session=spotify_auth_session,
     )
 
 
+def get_spotify(sp_oauth):
+    return spotipy.Spotify(auth_manager=sp_oauth, requests_session=spotify_session)
+
+
+def warm_up_connections():
+    # Opens the DynamoDB and Spotify connections ahead of the first real request.
+    try:
+        bot_table.get_item(Key={"chat_id": "warmup"})
+    except Exception as e:
+        logging.error(f"Error warming up DynamoDB: {e}")
+    for session, url in (
+        (spotify_session, SPOTIFY_API_URL),
+        (spotify_auth_session, SPOTIFY_ACCOUNTS_URL),
+    ):
+        try:
+            session.head(url, timeout=5)
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Error warming up connection to {url}: {e}")
+
+
 def add_track_to_spotify_playlist(playlist_id, track_id, sp_oauth):
     try:
-        sp = spotipy.Spotify(auth_manager=sp_oauth)
-        sp.playlist_add_items(playlist_id, [f"spotify:track:{track_id}"])
+        sp = get_spotify(sp_oauth)
+        call_spotify(sp.playlist_add_items, playlist_id, [f"spotify:track:{track_id}"])
         return True
+    except SpotifyUnavailableError:
+        raise
     except spotipy.exceptions.SpotifyException as e:
         if e.http_status == 403:
             logging.error("Insufficient client scope for modifying the playlist.")
         else:
             logging.error(f"An error occurred: {e}")
         return False
+    except SpotifyOauthError as e:
+        logging.error(f"Spotify authorization error: {e}")
+        return False
 
 
 def change_spotify_playlist_name(playlist_id, new_name, sp_oauth):
     try:
-        sp = spotipy.Spotify(auth_manager=sp_oauth)
-        sp.playlist_change_details(playlist_id, name=new_name)
+        sp = get_spotify(sp_oauth)
+        call_spotify(sp.playlist_change_details, playlist_id, name=new_name)
         return True
-    except SpotifyException as e:
+    except (SpotifyException, SpotifyUnavailableError) as e:
         logging.error(f"Spotify API error in changing playlist name: {e}")
         return False
     except Exception as e:
@@ -263,12 +689,171 @@ def change_spotify_playlist_name(playlist_id, new_name, sp_oauth):
 
 
 def create_spotify_playlist(playlist_name, sp_oauth):
-    sp = spotipy.Spotify(auth_manager=sp_oauth)
-    user_id = sp.current_user()["id"]
-    playlist = sp.user_playlist_create(user=user_id, name=playlist_name, public=True)
+    sp = get_spotify(sp_oauth)
+    user_id = call_spotify(sp.current_user)["id"]
+    playlist = call_spotify(
+        sp.user_playlist_create, user=user_id, name=playlist_name, public=True
+    )
     return playlist["id"]
 
 
+# -----------------------------------------------
+# Inline Search
+# -----------------------------------------------
+class TTLCache:
+    """
+    A bounded LRU cache whose entries expire ttl seconds after they are stored.
+    """
+
+    def __init__(self, maxsize, ttl, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if self.clock() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+# Maps a normalized query to (tracks, complete). Lives per process, so under
+# Lambda each container has its own. complete is True when Spotify
+# had no more matches than it returned, so the tracks for any longer query are
+# a subset of these.
+search_cache = TTLCache(INLINE_CACHE_SIZE, INLINE_CACHE_TTL)
+# Latest inline query id per user, so queries they have typed past are dropped.
+latest_inline_queries = TTLCache(INLINE_CACHE_SIZE, INLINE_CACHE_TTL)
+
+
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+
+def filter_tracks(tracks, query):
+    terms = query.split()
+    return [
+        track
+        for track in tracks
+        if all(
+            term in f"{track['name']} {track['artists']} {track['album']}".lower()
+            for term in terms
+        )
+    ]
+
+
+def find_cached_tracks(query):
+    cached = search_cache.get(query)
+    if cached is not None:
+        return cached[0]
+    # A complete result set for a query this one extends holds every match, so
+    # narrowing it down gives the same answer as Spotify would.
+    for end in range(len(query) - 1, 0, -1):
+        cached = search_cache.get(query[:end])
+        if cached is not None and cached[1]:
+            tracks = filter_tracks(cached[0], query)
+            search_cache.put(query, (tracks, True))
+            return tracks
+    return None
+
+
+@functools.cache
+def get_spotify_search():
+    # Inline queries carry no chat, so there are no playlist credentials to use.
+    # Searching only needs the app's own client credentials.
+    auth_manager = SpotifyClientCredentials(
+        SPOTIFY_CLIENT_ID,
+        SPOTIFY_CLIENT_SECRET,
+        requests_session=spotify_auth_session,
+        cache_handler=MemoryCacheHandler(),
+    )
+    return get_spotify(auth_manager)
+
+
+def search_spotify_tracks(query):
+    results = call_spotify(
+        get_spotify_search().search, q=query, type="track", limit=INLINE_RESULT_LIMIT
+    )["tracks"]
+    tracks = []
+    for item in results["items"]:
+        images = item["album"]["images"]
+        tracks.append(
+            {
+                "id": item["id"],
+                "name": item["name"],
+                "artists": ", ".join(artist["name"] for artist in item["artists"]),
+                "album": item["album"]["name"],
+                "thumbnail_url": images[-1]["url"] if images else None,
+            }
+        )
+    return tracks, results["total"] <= len(tracks)
+
+
+async def get_inline_tracks(inline_query, query, debounce):
+    # Returns None when the user typed on before the debounce ran out.
+    user_id = inline_query.from_user.id
+    latest_inline_queries.put(user_id, inline_query.id)
+    tracks = find_cached_tracks(query)
+    if tracks is not None:
+        return tracks
+    if debounce:
+        await asyncio.sleep(INLINE_DEBOUNCE)
+        if latest_inline_queries.get(user_id) != inline_query.id:
+            return None
+    tracks, complete = search_spotify_tracks(query)
+    search_cache.put(query, (tracks, complete))
+    return tracks
+
+
+async def handle_inline_query(update: Update, context: CallbackContext) -> None:
+    inline_query = update.inline_query
+    query = normalize_query(inline_query.query)
+    if not query:
+        await inline_query.answer([])
+        return
+    try:
+        tracks = await get_inline_tracks(
+            inline_query, query, context.bot_data["debounce_inline"]
+        )
+    except Exception as e:
+        logging.error(f"Error searching Spotify for inline query {query!r}: {e}")
+        await inline_query.answer([], cache_time=0)
+        return
+    if tracks is None:
+        # Superseded by a newer query; Telegram discards unanswered ones.
+        return
+    # Picking a result posts the track link, which handle_spotify_links then
+    # adds to the chat playlist.
+    results = [
+        InlineQueryResultArticle(
+            id=track["id"],
+            title=track["name"],
+            description=f"{track['artists']} · {track['album']}",
+            thumbnail_url=track["thumbnail_url"],
+            input_message_content=InputTextMessageContent(
+                f"https://open.spotify.com/track/{track['id']}"
+            ),
+        )
+        for track in tracks
+    ]
+    await inline_query.answer(results)
+
+
 # -----------------------------------------------
 # Telegram Message Handlers
 # -----------------------------------------------
@@ -305,8 +890,8 @@ async def handle_playlist_image(update: Update, context: CallbackContext) -> Non
 
             async def upload_image():
                 sp_oauth = get_sp_oauth(chat_id, user_id)
-                sp = spotipy.Spotify(auth_manager=sp_oauth)
-                sp.playlist_upload_cover_image(playlist_id, base64_image)
+                sp = get_spotify(sp_oauth)
+                call_spotify(sp.playlist_upload_cover_image, playlist_id, base64_image)
 
             await asyncio.wait_for(upload_image(), timeout=30)
             await update.message.reply_text("Playlist cover image set successfully!")
@@ -400,7 +985,20 @@ async def handle_spotify_links(update: Update, context: CallbackContext) -> None
     if match and playlist_id:
         track_id = match.group(1)
         sp_oauth = get_sp_oauth(chat_id, user_id)
-        if add_track_to_spotify_playlist(playlist_id, track_id, sp_oauth):
+        try:
+            added = add_track_to_spotify_playlist(playlist_id, track_id, sp_oauth)
+        except SpotifyUnavailableError:
+            if save_track_to_outbox(chat_id, user_id, playlist_id, track_id):
+                await update.message.reply_text(
+                    "Spotify is having trouble right now. "
+                    "I'll add this track as soon as it's back."
+                )
+            else:
+                await update.message.reply_text(
+                    "Spotify is having trouble right now. Please try again later."
+                )
+            return
+        if added:
             await update.message.set_reaction("👍")
         else:
             await update.message.reply_text(
@@ -444,7 +1042,11 @@ async def create_playlist(update: Update, context: CallbackContext) -> bool:
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
 
-    state_info = {"chat_id": str(chat_id), "user_id": str(user_id)}
+    state_info = {
+        "chat_id": str(chat_id),
+        "user_id": str(user_id),
+        "bot": current_bot.get(),
+    }
     state_encoded = json.dumps(state_info)
     state_url_safe = urllib.parse.quote(state_encoded)
 
@@ -496,7 +1098,7 @@ async def reset_playlist(update: Update, context: CallbackContext) -> None:
     chat_id = update.effective_chat.id
     # Delete the playlist entry from DynamoDB
     try:
-        bot_table.delete_item(Key={"chat_id": str(chat_id)})
+        bot_table.delete_item(Key={"chat_id": chat_key(chat_id)})
     except Exception as e:
         logging.error(f"Error deleting from DynamoDB: {e}")
         await update.message.reply_text("Failed to reset the playlist in the database.")
@@ -533,8 +1135,8 @@ async def start(update: Update, context: CallbackContext) -> None:
 async def unlink_credentials(update: Update, context: CallbackContext) -> None:
     chat_id = update.effective_chat.id
     try:
-        credentials_table.delete_item(Key={"chat_id": str(chat_id)})
-        bot_table.delete_item(Key={"chat_id": str(chat_id)})
+        credentials_table.delete_item(Key={"chat_id": chat_key(chat_id)})
+        bot_table.delete_item(Key={"chat_id": chat_key(chat_id)})
         await update.message.reply_text(
             "Your Spotify credentials have been unlinked successfully."
         )
@@ -545,14 +1147,25 @@ async def unlink_credentials(update: Update, context: CallbackContext) -> None:
         )
 
 
-def build_application(token):
+def build_application(token, bot_name=DEFAULT_BOT, debounce_inline=True):
+    # Debouncing inline queries only helps where a newer query can arrive while
+    # an older one waits, i.e. when updates are processed concurrently.
     logger.info(f"token: {token}")
     application = Application.builder().token(token).defaults(defaults).build()
+    application.bot_data["bot_name"] = bot_name
+    application.bot_data["debounce_inline"] = debounce_inline
     register_handlers(application)
     return application
 
 
+async def bind_bot_namespace(update: Update, context: CallbackContext) -> None:
+    # Runs before the other handlers of the update, in the same task, so they
+    # all read and write this bot's DynamoDB keys.
+    current_bot.set(context.bot_data["bot_name"])
+
+
 def register_handlers(application: Application):
+    application.add_handler(TypeHandler(Update, bind_bot_namespace), group=-1)
     handlers = [
         CommandHandler("start", start),
         CommandHandler("help", help_command),
@@ -567,6 +1180,8 @@ def register_handlers(application: Application):
         ),
         MessageHandler(filters.TEXT & ~filters.COMMAND, handle_playlist_name),
         MessageHandler(filters.PHOTO, handle_playlist_image),
+        # Non-blocking so a newer keystroke can supersede a debouncing query.
+        InlineQueryHandler(handle_inline_query, block=False),
     ]
 
     for handler in handlers:
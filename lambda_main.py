@@ -1,12 +1,17 @@
 import asyncio
+import hmac
 
+import boto3
 from bot import handle_spotify_auth, load_html_file
+from bot import replay_spotify_outbox, set_outbox_replay_scheduler
 import logging
-from bot import build_application
+from bot import BOTS, DEFAULT_BOT, build_application, warm_up_connections
 import os
 import json
 import traceback
+import warnings
 from telegram import Update
+from telegram.warnings import PTBUserWarning
 
 if logging.getLogger().hasHandlers():
     logging.getLogger().setLevel(logging.INFO)
@@ -14,29 +19,80 @@ else:
     logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
+# main() awaits the tasks of non-blocking handlers itself.
+warnings.filterwarnings(
+    "ignore",
+    message="Tasks created via `Application.create_task` while the application",
+    category=PTBUserWarning,
+)
+
+# Key of the self-invoked event that finishes the Spotify OAuth exchange.
+SPOTIFY_AUTH_EVENT = "spotify_auth"
+# Key of the self-invoked event that replays tracks queued during an outage.
+OUTBOX_REPLAY_EVENT = "outbox_replay"
+# Key of the event that initializes the container without processing an update.
+WARMUP_EVENT = "warmup"
+
+lambda_client = boto3.client("lambda", region_name=os.getenv("AWS_REGION", "us-east-1"))
+
+# The Applications and their HTTP connections live as long as the container, so
+# every invocation runs on the same event loop instead of a fresh asyncio.run().
+# One Application per bot, built the first time the bot gets a request.
+loop = asyncio.new_event_loop()
+applications = {}
+
 
 def lambda_handler(event, context):
     logger.info(f"Event body type: {type(event)}")
     logger.info(f"Event body content: {event}")
-    if event.get("body"):
+    if event.get(OUTBOX_REPLAY_EVENT):
+        # Sent when the Spotify circuit breaker closes, or on a schedule.
+        return handle_outbox_replay_event(event)
+    elif is_warmup_event(event):
+        # Scheduled pings or an explicit {"warmup": true} payload.
+        return loop.run_until_complete(warm_up())
+    elif event.get(SPOTIFY_AUTH_EVENT):
+        # Asynchronous follow-up of the /spotifyauth callback. Raising here lets
+        # Lambda retry the invocation.
+        return handle_spotify_auth_event(event)
+    elif event.get("body"):
         # I'm a telegram bot post webhook served via the API GAteway.
-        return asyncio.run(main(event, context))
+        return loop.run_until_complete(main(event, context))
     elif event.get("rawPath") == "/spotifyauth":
         # This is served by the Lambda Function URL.
         # Spotify API refers to this as the redirect URI and it is also the path
         # you've specified in your Spotify Developer Dashboard.
-        return handle_spotify_event(event)
+        return handle_spotify_event(event, context)
     else:
         return {"statusCode": 404, "body": "no handler for this request"}
 
 
-def handle_spotify_event(event):
-    state_encoded = event["queryStringParameters"].get("state")
-    code = event["queryStringParameters"].get("code")
+def handle_spotify_event(event, context):
+    query = event.get("queryStringParameters") or {}
+    state_encoded = query.get("state")
+    code = query.get("code")
 
     if not state_encoded or not code:
         return {"statusCode": 400, "body": "Missing required parameters"}
-    handle_spotify_auth(state_encoded, code)
+    # Hand the token exchange and the Telegram notification off to an
+    # asynchronous invocation of this same function so the browser gets the
+    # page right away.
+    try:
+        lambda_client.invoke(
+            FunctionName=context.invoked_function_arn,
+            InvocationType="Event",
+            Payload=json.dumps(
+                {SPOTIFY_AUTH_EVENT: {"state": state_encoded, "code": code}}
+            ),
+        )
+    except Exception as e:
+        # The code is single-use, so finish the login here rather than lose it.
+        logger.error(f"Error invoking the Spotify auth event, running inline: {e}")
+        try:
+            handle_spotify_auth(state_encoded, code)
+        except Exception:
+            logger.exception("Error handling Spotify auth")
+            return {"statusCode": 500, "body": "Spotify authorization failed"}
     html_content = load_html_file("index.html")
     return {
         "statusCode": 200,
@@ -45,9 +101,84 @@ def handle_spotify_event(event):
     }
 
 
+def handle_spotify_auth_event(event):
+    auth = event[SPOTIFY_AUTH_EVENT]
+    handle_spotify_auth(auth["state"], auth["code"])
+    return {"statusCode": 200, "body": json.dumps("Success")}
+
+
+def invoke_outbox_replay(start_key=None):
+    lambda_client.invoke(
+        FunctionName=os.getenv("AWS_LAMBDA_FUNCTION_NAME"),
+        InvocationType="Event",
+        Payload=json.dumps({OUTBOX_REPLAY_EVENT: {"start_key": start_key}}),
+    )
+
+
+# Keep the replay out of the request that happened to close the breaker.
+set_outbox_replay_scheduler(invoke_outbox_replay)
+
+
+def handle_outbox_replay_event(event):
+    replay = event[OUTBOX_REPLAY_EVENT]
+    start_key = replay.get("start_key") if isinstance(replay, dict) else None
+    next_key = replay_spotify_outbox(start_key)
+    if next_key:
+        # More rows than one scan page; carry on in a fresh invocation.
+        invoke_outbox_replay(next_key)
+    return {"statusCode": 200, "body": json.dumps("Success")}
+
+
+def is_warmup_event(event):
+    return bool(event.get(WARMUP_EVENT)) or event.get("source") == "aws.events"
+
+
+def resolve_bot(event):
+    # Telegram sends the secret_token given to setWebhook in a header. Bots can
+    # also be told apart by the last segment of the webhook path, e.g.
+    # /telegram/skunk. Anything else goes to the default bot, if there is one.
+    headers = {k.lower(): v for k, v in (event.get("headers") or {}).items()}
+    secret = headers.get("x-telegram-bot-api-secret-token")
+    if secret:
+        for bot_name, config in BOTS.items():
+            if config.get("secret") and hmac.compare_digest(config["secret"], secret):
+                return bot_name
+        return None
+
+    path = event.get("rawPath") or event.get("path") or ""
+    bot_name = path.rstrip("/").rsplit("/", 1)[-1]
+    if bot_name not in BOTS:
+        bot_name = DEFAULT_BOT
+    if bot_name not in BOTS or BOTS[bot_name].get("secret"):
+        # Bots with a secret only accept requests carrying it.
+        return None
+    return bot_name
+
+
+async def get_application(bot_name):
+    if bot_name not in applications:
+        TOKEN = BOTS[bot_name]["token"]
+        # Each invocation carries a single update, so a newer keystroke never
+        # reaches the container while an older query waits; don't debounce.
+        application = build_application(TOKEN, bot_name, debounce_inline=False)
+        await application.initialize()
+        applications[bot_name] = application
+    return applications[bot_name]
+
+
+async def warm_up():
+    # Initializing an Application calls getMe, which opens the Telegram
+    # connection. DynamoDB and Spotify are opened in bot.py.
+    for bot_name in BOTS:
+        await get_application(bot_name)
+    warm_up_connections()
+    return {"statusCode": 200, "body": json.dumps("Warm")}
+
+
 async def main(event, context):
-    TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-    application = build_application(TOKEN)
+    bot_name = resolve_bot(event)
+    if bot_name is None:
+        return {"statusCode": 404, "body": "no bot for this request"}
 
     # Convert the incoming event to a Telegram Update object
     if isinstance(event["body"], str):
@@ -56,8 +187,12 @@ async def main(event, context):
         body = event["body"]
 
     try:
-        await application.initialize()
+        application = await get_application(bot_name)
+        pending = asyncio.all_tasks()
         await application.process_update(Update.de_json(body, application.bot))
+        # Non-blocking handlers run as tasks; finish them before Lambda freezes
+        # the container.
+        await asyncio.gather(*(asyncio.all_tasks() - pending))
         return {"statusCode": 200, "body": json.dumps("Success")}
     except Exception:
         logger.exception("Error processing update")
@@ -65,10 +200,17 @@ async def main(event, context):
             "statusCode": 500,
             "body": f"Error processing update: {traceback.format_exc()}",
         }
-    finally:
-        await application.shutdown()
-        logger.info("application.shutdown")
 
 
+# Provisioned concurrency runs the module init ahead of any request, so warm up
+# right away instead of waiting for a ping.
+if os.getenv("AWS_LAMBDA_INITIALIZATION_TYPE") == "provisioned-concurrency":
+    try:
+        loop.run_until_complete(warm_up())
+    except Exception as e:
+        # A failed warm-up must not fail the container init; requests will
+        # initialize whatever is missing.
+        logger.error(f"Error warming up during init: {e}")
+
 if __name__ == "__main__":
     main()
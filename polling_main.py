@@ -1,7 +1,7 @@
-import os
+import asyncio
 import threading
 from flask import Flask, request
-from bot import build_application, load_html_file
+from bot import BOTS, build_application, load_html_file
 from bot import handle_spotify_auth
 import logging
 from flask import Response
@@ -24,7 +24,10 @@ def callback():
     code = request.args.get("code")
     state = request.args.get("state")
     logger.info(f"honey we got the code: {code}, and the state: {state}")
-    handle_spotify_auth(state, code)
+    # Finish the token exchange in the background so the page renders at once.
+    threading.Thread(
+        target=handle_spotify_auth, args=(state, code), daemon=True
+    ).start()
     return Response(html_content, status=200, content_type="text/html")
 
 
@@ -32,15 +35,32 @@ def run_flask_app():
     webserver.run(host="0.0.0.0", port=8080, debug=True, use_reloader=False)
 
 
-if __name__ == "__main__":
-    TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-    application = build_application(TOKEN)
+async def run_polling():
+    # run_polling() only drives one Application, so start each bot by hand and
+    # poll them side by side.
+    applications = [
+        build_application(config["token"], bot_name)
+        for bot_name, config in BOTS.items()
+    ]
+    for application in applications:
+        await application.initialize()
+        await application.start()
+        await application.updater.start_polling()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for application in applications:
+            await application.updater.stop()
+            await application.stop()
+            await application.shutdown()
+
 
+if __name__ == "__main__":
     # Start the Flask app in a separate thread
     threading.Thread(target=run_flask_app, daemon=True).start()
 
     # Start polling
-    application.run_polling()
+    asyncio.run(run_polling())
     # Main thread does something totally different.
     # i = 0
     # while True:
@@ -1,8 +1,16 @@
+import asyncio
+import json
 import unittest
-from unittest.mock import AsyncMock, MagicMock
+from unittest.mock import AsyncMock, MagicMock, call, patch
+import requests
+from botocore.exceptions import ClientError
+from spotipy.exceptions import SpotifyException
+from spotipy.oauth2 import SpotifyOauthError
 from telegram import Update, Message, User, Chat
-from telegram.ext import CallbackContext
-from bot import start, help_command
+from telegram.ext import CallbackContext, ExtBot, TypeHandler
+from bot import start, help_command, SpotifyCircuitBreaker, TTLCache
+import bot
+import lambda_main
 
 
 class TestStartCommand(unittest.IsolatedAsyncioTestCase):
@@ -59,5 +67,560 @@ class TestHelpCommand(unittest.IsolatedAsyncioTestCase):
         self.update.message.reply_text.assert_awaited_once_with(expected_text)
 
 
+class TestSpotifyAuthCallback(unittest.TestCase):
+    def test_callback_defers_token_exchange(self):
+        event = {
+            "rawPath": "/spotifyauth",
+            "queryStringParameters": {"state": "some-state", "code": "some-code"},
+        }
+        context = MagicMock()
+        context.invoked_function_arn = "arn:aws:lambda:us-east-1:1:function:skunk"
+
+        with (
+            patch.object(lambda_main, "lambda_client") as lambda_client,
+            patch.object(lambda_main, "handle_spotify_auth") as handle_spotify_auth,
+        ):
+            response = lambda_main.lambda_handler(event, context)
+
+        self.assertEqual(response["statusCode"], 200)
+        handle_spotify_auth.assert_not_called()
+        lambda_client.invoke.assert_called_once()
+        kwargs = lambda_client.invoke.call_args.kwargs
+        self.assertEqual(kwargs["InvocationType"], "Event")
+        self.assertEqual(
+            json.loads(kwargs["Payload"]),
+            {"spotify_auth": {"state": "some-state", "code": "some-code"}},
+        )
+
+    def test_callback_falls_back_to_inline_exchange_when_invoke_fails(self):
+        event = {
+            "rawPath": "/spotifyauth",
+            "queryStringParameters": {"state": "some-state", "code": "some-code"},
+        }
+
+        with (
+            patch.object(lambda_main, "lambda_client") as lambda_client,
+            patch.object(lambda_main, "handle_spotify_auth") as handle_spotify_auth,
+        ):
+            lambda_client.invoke.side_effect = Exception("AccessDenied")
+            response = lambda_main.lambda_handler(event, MagicMock())
+
+        self.assertEqual(response["statusCode"], 200)
+        handle_spotify_auth.assert_called_once_with("some-state", "some-code")
+
+    def test_auth_event_runs_token_exchange(self):
+        event = {"spotify_auth": {"state": "some-state", "code": "some-code"}}
+
+        with patch.object(lambda_main, "handle_spotify_auth") as handle_spotify_auth:
+            response = lambda_main.lambda_handler(event, MagicMock())
+
+        self.assertEqual(response["statusCode"], 200)
+        handle_spotify_auth.assert_called_once_with("some-state", "some-code")
+
+
+class TestSpotifyAuthNotification(unittest.TestCase):
+    def test_notification_failure_is_not_raised(self):
+        state = json.dumps({"chat_id": "12345", "user_id": "67890"})
+        sp_oauth = MagicMock()
+        sp_oauth.get_access_token.return_value = {"access_token": "token"}
+
+        with (
+            patch.object(bot, "BOTS", {"default": {"token": "1:a"}}),
+            patch.object(bot, "get_sp_oauth", return_value=sp_oauth),
+            patch.object(bot.telegram, "Bot") as telegram_bot,
+        ):
+            telegram_bot.return_value.send_message = AsyncMock(
+                side_effect=Exception("Telegram is down")
+            )
+            bot.handle_spotify_auth(state, "some-code")
+
+        sp_oauth.get_access_token.assert_called_once_with("some-code")
+
+
+class TestWarmUp(unittest.TestCase):
+    def setUp(self):
+        patcher = patch.multiple(
+            lambda_main, BOTS={"default": {"token": "123:abc"}}, applications={}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_warmup_event_initializes_without_processing_an_update(self):
+        application = MagicMock()
+        application.initialize = AsyncMock()
+        application.process_update = AsyncMock()
+
+        with (
+            patch.object(
+                lambda_main, "build_application", return_value=application
+            ) as build_application,
+            patch.object(lambda_main, "warm_up_connections") as warm_up_connections,
+        ):
+            response = lambda_main.lambda_handler({"warmup": True}, MagicMock())
+            lambda_main.lambda_handler({"warmup": True}, MagicMock())
+
+        self.assertEqual(response["statusCode"], 200)
+        build_application.assert_called_once_with(
+            "123:abc", "default", debounce_inline=False
+        )
+        application.initialize.assert_awaited_once()
+        application.process_update.assert_not_awaited()
+        self.assertEqual(warm_up_connections.call_count, 2)
+
+
+class TestMultiBot(unittest.TestCase):
+    def setUp(self):
+        patcher = patch.object(
+            lambda_main,
+            "BOTS",
+            {
+                "default": {"token": "1:a"},
+                "skunk": {"token": "2:b"},
+                "polecat": {"token": "3:c", "secret": "s3cr3t"},
+            },
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_routes_by_path_and_secret(self):
+        resolve_bot = lambda_main.resolve_bot
+        self.assertEqual(resolve_bot({"rawPath": "/telegram/skunk"}), "skunk")
+        self.assertEqual(resolve_bot({"rawPath": "/telegram"}), "default")
+        self.assertEqual(
+            resolve_bot({"headers": {"X-Telegram-Bot-Api-Secret-Token": "s3cr3t"}}),
+            "polecat",
+        )
+        self.assertIsNone(resolve_bot({"rawPath": "/telegram/polecat"}))
+        self.assertIsNone(
+            resolve_bot({"headers": {"X-Telegram-Bot-Api-Secret-Token": "wrong"}})
+        )
+
+    def test_chat_keys_are_namespaced_per_bot(self):
+        self.assertEqual(bot.chat_key(12345), "12345")
+        with bot.bot_namespace("skunk"):
+            self.assertEqual(bot.chat_key(12345), "skunk:12345")
+        self.assertEqual(bot.chat_key(12345), "12345")
+
+
+class TestBotNamespaceBinding(unittest.IsolatedAsyncioTestCase):
+    async def test_handlers_see_their_bots_namespace(self):
+        application = bot.build_application("123:abc", "skunk")
+        seen = []
+
+        async def record_key(update, context):
+            seen.append(bot.chat_key(update.effective_chat.id))
+
+        application.add_handler(TypeHandler(Update, record_key), group=1)
+        chat = Chat(id=12345, type="private")
+        user = User(id=67890, is_bot=False, first_name="Test User")
+        update = Update(
+            update_id=1,
+            message=Message(message_id=1, date=1609459200, chat=chat, from_user=user),
+        )
+
+        with (
+            patch.object(ExtBot, "get_me", AsyncMock()),
+            patch.multiple(
+                bot,
+                get_current_state=MagicMock(return_value=None),
+                get_user_id_from_chat_id=MagicMock(return_value=None),
+                get_user_id_from_channel_credentials=MagicMock(return_value=None),
+                get_sp_oauth=MagicMock(),
+            ),
+        ):
+            await application.initialize()
+            try:
+                await application.process_update(update)
+            finally:
+                await application.shutdown()
+
+        self.assertEqual(seen, ["skunk:12345"])
+
+
+class TestSpotifyAuthUnknownBot(unittest.TestCase):
+    def test_unknown_bot_is_logged_not_raised(self):
+        state = json.dumps({"chat_id": "12345", "user_id": "67890", "bot": "gone"})
+
+        with (
+            patch.object(bot, "BOTS", {"skunk": {"token": "1:a"}}),
+            patch.object(bot, "get_sp_oauth") as get_sp_oauth,
+        ):
+            bot.handle_spotify_auth(state, "some-code")
+
+        get_sp_oauth.assert_not_called()
+
+
+class TestSpotifyCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.breaker = SpotifyCircuitBreaker(
+            failure_rate=0.5,
+            min_calls=4,
+            window=60,
+            cooldown=30,
+            clock=lambda: self.now,
+        )
+
+    def test_opens_when_failure_rate_crosses_threshold(self):
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow_request())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, SpotifyCircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow_request())
+
+    def test_closes_after_successful_trial_and_requests_replay(self):
+        for _ in range(4):
+            self.breaker.record_failure()
+        self.now += 31
+        self.assertTrue(self.breaker.allow_request())
+        self.assertFalse(self.breaker.allow_request())
+        self.assertTrue(self.breaker.record_success())
+        self.assertEqual(self.breaker.state, SpotifyCircuitBreaker.CLOSED)
+        self.assertFalse(self.breaker.record_success())
+
+    def test_failed_trial_reopens(self):
+        for _ in range(4):
+            self.breaker.record_failure()
+        self.now += 31
+        self.assertTrue(self.breaker.allow_request())
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.allow_request())
+
+
+def make_oauth_error(status):
+    # spotipy raises SpotifyOauthError while handling the HTTPError.
+    response = requests.Response()
+    response.status_code = status
+    try:
+        try:
+            raise requests.exceptions.HTTPError(response=response)
+        except requests.exceptions.HTTPError:
+            raise SpotifyOauthError("token refresh failed")
+    except SpotifyOauthError as e:
+        return e
+
+
+def outbox_item(outbox_id, playlist_id, track_id, created_at):
+    return {
+        "outbox_id": outbox_id,
+        "bot": "default",
+        "chat_id": "12345",
+        "user_id": "67890",
+        "playlist_id": playlist_id,
+        "track_id": track_id,
+        "created_at": created_at,
+    }
+
+
+class TestSpotifyOutbox(unittest.TestCase):
+    def setUp(self):
+        self.breaker = SpotifyCircuitBreaker(
+            failure_rate=0.5, min_calls=4, window=60, cooldown=30
+        )
+        self.outbox_table = MagicMock()
+        self.sp = MagicMock()
+        patcher = patch.multiple(
+            bot,
+            spotify_breaker=self.breaker,
+            outbox_table=self.outbox_table,
+            get_sp_oauth=MagicMock(),
+            get_spotify=MagicMock(return_value=self.sp),
+            schedule_outbox_replay=MagicMock(),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.items = [
+            outbox_item("1", "playlist-a", "track-1", 1),
+            outbox_item("2", "playlist-b", "track-2", 2),
+            outbox_item("3", "playlist-a", "track-3", 3),
+            outbox_item("4", "playlist-a", "track-4", 4),
+        ]
+        self.outbox_table.scan.return_value = {"Items": self.items}
+        self.outbox_table.delete_item.side_effect = self.claim
+        self.released = (
+            self.outbox_table.batch_writer.return_value.__enter__.return_value.put_item
+        )
+
+    def claim(self, Key, **kwargs):
+        if Key["outbox_id"] == "4":
+            # Another container claimed it first.
+            raise ClientError(
+                {"Error": {"Code": "ConditionalCheckFailedException"}}, "DeleteItem"
+            )
+        item = next(i for i in self.items if i["outbox_id"] == Key["outbox_id"])
+        return {"Attributes": item}
+
+    def test_replays_claimed_tracks_in_batches_per_playlist(self):
+        self.assertIsNone(bot.replay_spotify_outbox())
+
+        self.assertEqual(self.outbox_table.delete_item.call_count, 4)
+        self.sp.playlist_add_items.assert_has_calls(
+            [
+                call("playlist-a", ["spotify:track:track-1", "spotify:track:track-3"]),
+                call("playlist-b", ["spotify:track:track-2"]),
+            ]
+        )
+        self.assertEqual(self.sp.playlist_add_items.call_count, 2)
+        self.released.assert_not_called()
+
+    def test_continues_paginated_scan_from_last_key(self):
+        self.outbox_table.scan.return_value = {
+            "Items": self.items,
+            "LastEvaluatedKey": {"outbox_id": "4"},
+        }
+        self.assertEqual(bot.replay_spotify_outbox(), {"outbox_id": "4"})
+
+        self.outbox_table.scan.return_value = {"Items": []}
+        self.assertIsNone(bot.replay_spotify_outbox({"outbox_id": "4"}))
+        self.assertEqual(
+            self.outbox_table.scan.call_args.kwargs["ExclusiveStartKey"],
+            {"outbox_id": "4"},
+        )
+
+    def test_page_of_released_tracks_does_not_reinvoke(self):
+        self.sp.playlist_add_items.side_effect = make_oauth_error(400)
+        self.outbox_table.scan.return_value = {
+            "Items": self.items,
+            "LastEvaluatedKey": {"outbox_id": "4"},
+        }
+
+        with patch.object(lambda_main, "lambda_client") as lambda_client:
+            lambda_main.lambda_handler({"outbox_replay": True}, MagicMock())
+
+        self.assertEqual(self.released.call_count, 3)
+        lambda_client.invoke.assert_not_called()
+
+    def test_paginated_replay_reinvokes_with_start_key(self):
+        self.outbox_table.scan.return_value = {
+            "Items": self.items,
+            "LastEvaluatedKey": {"outbox_id": "4"},
+        }
+
+        with patch.object(lambda_main, "lambda_client") as lambda_client:
+            lambda_main.lambda_handler(
+                {"outbox_replay": {"start_key": {"outbox_id": "0"}}}, MagicMock()
+            )
+
+        self.assertEqual(
+            self.outbox_table.scan.call_args.kwargs["ExclusiveStartKey"],
+            {"outbox_id": "0"},
+        )
+        payload = json.loads(lambda_client.invoke.call_args.kwargs["Payload"])
+        self.assertEqual(payload, {"outbox_replay": {"start_key": {"outbox_id": "4"}}})
+
+    def test_outage_returns_claimed_tracks_to_outbox(self):
+        self.sp.playlist_add_items.side_effect = SpotifyException(503, -1, "down")
+
+        self.assertFalse(bot.replay_spotify_outbox())
+
+        self.sp.playlist_add_items.assert_called_once()
+        released = [c.kwargs["Item"]["outbox_id"] for c in self.released.call_args_list]
+        self.assertEqual(sorted(released), ["1", "2", "3"])
+
+    def test_auth_errors_keep_tracks_in_outbox(self):
+        self.sp.playlist_add_items.side_effect = make_oauth_error(400)
+
+        bot.replay_spotify_outbox()
+
+        released = [c.kwargs["Item"] for c in self.released.call_args_list]
+        self.assertEqual(sorted(i["outbox_id"] for i in released), ["1", "2", "3"])
+        self.assertTrue(all(item["attempts"] == 1 for item in released))
+
+    def test_drops_tracks_after_max_attempts(self):
+        self.sp.playlist_add_items.side_effect = make_oauth_error(400)
+        self.items[0]["attempts"] = bot.OUTBOX_MAX_ATTEMPTS - 1
+
+        bot.replay_spotify_outbox()
+
+        released = [c.kwargs["Item"]["outbox_id"] for c in self.released.call_args_list]
+        self.assertEqual(sorted(released), ["2", "3"])
+
+    def test_drops_tracks_spotify_rejects(self):
+        self.sp.playlist_add_items.side_effect = SpotifyException(404, -1, "gone")
+
+        bot.replay_spotify_outbox()
+
+        self.released.assert_not_called()
+
+    def test_token_refresh_outage_counts_against_breaker(self):
+        self.assertTrue(bot.is_spotify_outage(make_oauth_error(503)))
+        self.assertFalse(bot.is_spotify_outage(make_oauth_error(400)))
+        for _ in range(4):
+            with self.assertRaises(bot.SpotifyUnavailableError):
+                bot.call_spotify(MagicMock(side_effect=make_oauth_error(503)))
+        self.assertEqual(self.breaker.state, SpotifyCircuitBreaker.OPEN)
+
+    def test_non_outage_errors_do_not_trip_breaker(self):
+        for _ in range(4):
+            with self.assertRaises(SpotifyException):
+                bot.call_spotify(
+                    MagicMock(side_effect=SpotifyException(404, -1, "gone"))
+                )
+        self.assertEqual(self.breaker.state, SpotifyCircuitBreaker.CLOSED)
+
+    def test_closing_breaker_schedules_replay(self):
+        for _ in range(4):
+            self.breaker.record_failure()
+        self.breaker.opened_at -= 31
+
+        bot.call_spotify(MagicMock())
+
+        bot.schedule_outbox_replay.assert_called_once()
+
+
+class TestSpotifyLinkOutage(unittest.IsolatedAsyncioTestCase):
+    async def test_queues_track_when_spotify_is_unavailable(self):
+        update = MagicMock(spec=Update)
+        update.effective_chat.id = 12345
+        update.effective_user.id = 67890
+        update.message.text = "https://open.spotify.com/track/abc123"
+        update.message.reply_text = AsyncMock()
+        outbox_table = MagicMock()
+
+        with patch.multiple(
+            bot,
+            outbox_table=outbox_table,
+            get_current_state=MagicMock(return_value=None),
+            get_playlist_from_dynamodb=MagicMock(return_value="playlist-a"),
+            get_sp_oauth=MagicMock(),
+            add_track_to_spotify_playlist=MagicMock(
+                side_effect=bot.SpotifyUnavailableError()
+            ),
+        ):
+            await bot.handle_spotify_links(update, MagicMock())
+
+        item = outbox_table.put_item.call_args.kwargs["Item"]
+        self.assertEqual(
+            (item["chat_id"], item["user_id"], item["playlist_id"], item["track_id"]),
+            ("12345", "67890", "playlist-a", "abc123"),
+        )
+        update.message.reply_text.assert_awaited_once_with(
+            "Spotify is having trouble right now. "
+            "I'll add this track as soon as it's back."
+        )
+
+
+class TestTTLCache(unittest.TestCase):
+    def test_evicts_least_recently_used_and_expired_entries(self):
+        now = [0.0]
+        cache = TTLCache(maxsize=2, ttl=10, clock=lambda: now[0])
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        now[0] = 10
+        self.assertIsNone(cache.get("c"))
+
+
+class TestInlineSearch(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        patcher = patch.multiple(
+            bot,
+            search_cache=TTLCache(16, 300),
+            latest_inline_queries=TTLCache(16, 300),
+            INLINE_DEBOUNCE=0.01,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tracks = [
+            {
+                "id": "1",
+                "name": "Yesterday",
+                "artists": "The Beatles",
+                "album": "Help!",
+                "thumbnail_url": None,
+            },
+            {
+                "id": "2",
+                "name": "Help!",
+                "artists": "The Beatles",
+                "album": "Help!",
+                "thumbnail_url": None,
+            },
+        ]
+
+    def inline_update(self, query_id, query, user_id=1):
+        update = MagicMock(spec=Update)
+        update.inline_query.id = query_id
+        update.inline_query.query = query
+        update.inline_query.from_user.id = user_id
+        update.inline_query.answer = AsyncMock()
+        return update
+
+    def context(self, debounce_inline=True):
+        context = MagicMock(spec=CallbackContext)
+        context.bot_data = {"debounce_inline": debounce_inline}
+        return context
+
+    async def test_reuses_complete_prefix_results(self):
+        first = self.inline_update("q1", "beatles", user_id=1)
+        second = self.inline_update("q2", "Beatles  yes", user_id=2)
+        with patch.object(
+            bot, "search_spotify_tracks", return_value=(self.tracks, True)
+        ) as search:
+            await bot.handle_inline_query(first, self.context())
+            await bot.handle_inline_query(second, self.context())
+
+        search.assert_called_once_with("beatles")
+        results = second.inline_query.answer.call_args.args[0]
+        self.assertEqual([result.id for result in results], ["1"])
+
+    async def test_only_searches_latest_query_while_typing(self):
+        updates = [
+            self.inline_update("q1", "beatles"),
+            self.inline_update("q2", "beatles he"),
+            self.inline_update("q3", "beatles help"),
+        ]
+        with patch.object(
+            bot, "search_spotify_tracks", return_value=(self.tracks, False)
+        ) as search:
+            await asyncio.gather(
+                *(bot.handle_inline_query(update, self.context()) for update in updates)
+            )
+
+        search.assert_called_once_with("beatles help")
+        updates[0].inline_query.answer.assert_not_awaited()
+        updates[1].inline_query.answer.assert_not_awaited()
+        updates[2].inline_query.answer.assert_awaited_once()
+
+    async def test_searches_right_away_without_debounce(self):
+        updates = [
+            self.inline_update("q1", "beatles"),
+            self.inline_update("q2", "beatles help"),
+        ]
+        with (
+            patch.object(
+                bot, "search_spotify_tracks", return_value=(self.tracks, False)
+            ) as search,
+            patch.object(bot.asyncio, "sleep") as sleep,
+        ):
+            for update in updates:
+                await bot.handle_inline_query(update, self.context(False))
+
+        sleep.assert_not_called()
+        self.assertEqual(search.call_count, 2)
+        updates[0].inline_query.answer.assert_awaited_once()
+
+    async def test_incomplete_prefix_results_are_not_reused(self):
+        with patch.object(
+            bot, "search_spotify_tracks", return_value=(self.tracks, False)
+        ) as search:
+            await bot.handle_inline_query(
+                self.inline_update("q1", "beatles"), self.context()
+            )
+            await bot.handle_inline_query(
+                self.inline_update("q2", "beatles help"), self.context()
+            )
+
+        self.assertEqual(
+            [call.args[0] for call in search.call_args_list],
+            ["beatles", "beatles help"],
+        )
+
+
 if __name__ == "__main__":
     unittest.main()